@@ -1,14 +1,22 @@
 import os
 import re
-import json
 import time
 import html
+import asyncio
+import heapq
 import hashlib
-from typing import Dict, Any, List, Set, Tuple, Optional
+import multiprocessing
+from calendar import timegm
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
+from typing import Deque, Dict, Any, List, Set, Tuple, Optional
 from urllib.parse import urlparse
 
-import requests
+import orjson
+import aiohttp
 import feedparser
+from selectolax.lexbor import LexborHTMLParser
 
 
 # ---------------------------
@@ -35,11 +43,23 @@ STATE_FILE = os.environ.get("STATE_FILE", "state.json")
 MAX_POSTS_PER_RUN = int(os.environ.get("MAX_POSTS_PER_RUN", "6"))
 SEEN_LIMIT = int(os.environ.get("SEEN_LIMIT", "2000"))
 REQUEST_TIMEOUT = int(os.environ.get("REQUEST_TIMEOUT", "20"))
-SLEEP_BETWEEN_POSTS = float(os.environ.get("SLEEP_BETWEEN_POSTS", "1.2"))
+
+# Telegram allows about 1 message per second in a chat: at most RATE_LIMIT
+# posts per RATE_WINDOW seconds, counted from when each send completed.
+# SLEEP_BETWEEN_POSTS is the legacy name; 1.2 s keeps a margin over 1/s.
+RATE_LIMIT = int(os.environ.get("RATE_LIMIT", "1"))
+RATE_WINDOW = float(
+    os.environ.get("RATE_WINDOW", os.environ.get("SLEEP_BETWEEN_POSTS", "1.2"))
+)
 
 # Diversity setting: max 1 post per source per run
 ONE_PER_SOURCE = os.environ.get("ONE_PER_SOURCE", "1") == "1"
 
+# Cross-source dedup: skip a title too similar to one of the last
+# TITLE_HISTORY posted titles (Jaccard over 3-word shingles)
+TITLE_HISTORY = int(os.environ.get("TITLE_HISTORY", "100"))
+TITLE_SIMILARITY = float(os.environ.get("TITLE_SIMILARITY", "0.3"))
+
 UA = os.environ.get(
     "USER_AGENT",
     "RegardiRSSBot/1.0 (+https://regardi.fr; contact@regardi.fr)"
@@ -51,42 +71,87 @@ UA = os.environ.get(
 # ---------------------------
 def load_state() -> Dict[str, Any]:
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if isinstance(data, dict) and "seen" in data and isinstance(data["seen"], list):
-                return data
+        with open(STATE_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+            if isinstance(data, dict) and "seen" in data:
+                seen = data["seen"]
+                if isinstance(seen, list):
+                    # Legacy format: oldest-first list of fingerprints
+                    data["seen"] = dict.fromkeys(seen, 0)
+                if isinstance(data["seen"], dict):
+                    if not isinstance(data.get("seen_links"), dict):
+                        data["seen_links"] = {}
+                    if not isinstance(data.get("feeds"), dict):
+                        data["feeds"] = {}
+                    titles = data.get("recent_titles")
+                    if not isinstance(titles, list):
+                        titles = []
+                    # Non-string items would crash the shingle check each run
+                    data["recent_titles"] = [t for t in titles if isinstance(t, str)]
+                    return data
     except Exception:
         pass
-    return {"seen": []}
+    return {"seen": {}, "seen_links": {}, "feeds": {}, "recent_titles": []}
 
 
 def save_state(state: Dict[str, Any]) -> None:
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    buf = orjson.dumps(state)
+
+    # Skip the write when the file on disk already holds the same bytes
+    try:
+        with open(STATE_FILE, "rb") as f:
+            if f.read() == buf:
+                return
+    except OSError:
+        pass
+
+    # Write to a temp file then rename, so a crash never leaves a torn state
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(buf)
+    os.replace(tmp, STATE_FILE)
 
 
 # ---------------------------
 # Text utilities
 # ---------------------------
-def norm_space(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "").strip())
+_RE_WS = re.compile(r"\s+")
+_RE_WORD = re.compile(r"\w+")
+_BLOCK_TAGS = "p, div, li, h1, h2, h3, h4, h5, h6, blockquote, tr"
 
 
-def strip_html(s: str) -> str:
-    s = s or ""
-    s = re.sub(r"<br\s*/?>", "\n", s, flags=re.I)
-    s = re.sub(r"<[^>]+>", "", s)
-    return html.unescape(s)
+def norm_space(s: str) -> str:
+    return _RE_WS.sub(" ", (s or "").strip())
 
 
+def strip_html(s: str) -> str:
+    if not s:
+        return ""
+    # One C-level pass: drops tags, decodes entities, skips script/style.
+    # Inline tags join without a space; only line breaks and block ends
+    # become whitespace.
+    tree = LexborHTMLParser(s)
+    tree.strip_tags(["script", "style"])
+    for node in tree.css("br"):
+        node.replace_with("\n")
+    for node in tree.css(_BLOCK_TAGS):
+        node.insert_after("\n")
+    return tree.text(separator="")
+
+
+def clean_title(title: str) -> str:
+    if "<" in title:
+        # feedparser does not sanitize, so titles may carry markup
+        title = strip_html(title)
+    return norm_space(title)
+
+
+@lru_cache(maxsize=1024)
 def normalize_text(s: str) -> str:
-    s = (s or "").lower().strip()
-    s = re.sub(r"\s+", " ", s)
-    return s
+    return _RE_WS.sub(" ", (s or "").lower().strip())
 
 
-def short_summary(entry: Any, max_chars: int = 280) -> str:
-    raw = getattr(entry, "summary", "") or getattr(entry, "description", "") or ""
+def short_summary(raw: str, max_chars: int = 280) -> str:
     txt = norm_space(strip_html(raw))
     if not txt:
         return ""
@@ -98,6 +163,7 @@ def short_summary(entry: Any, max_chars: int = 280) -> str:
 # ---------------------------
 # Source detection
 # ---------------------------
+@lru_cache(maxsize=256)
 def host_from_url(url: str) -> str:
     try:
         host = urlparse(url).netloc.lower().replace("www.", "")
@@ -125,19 +191,115 @@ def nice_source_name(feed_obj: Any, fallback_link: str = "") -> str:
 # ---------------------------
 # Dedup fingerprint (strong)
 # ---------------------------
-def make_fingerprint(entry: Any, source: str) -> str:
-    title = normalize_text(getattr(entry, "title", ""))
-    summary = normalize_text(getattr(entry, "summary", "") or getattr(entry, "description", ""))
-    link = normalize_text(getattr(entry, "link", ""))
+def fingerprint_parts(
+    source: str, title: str, summary: str, link: str
+) -> Tuple[str, str, str, str]:
     # include source to reduce weird collisions
-    base = f"{normalize_text(source)}|{title}|{summary[:600]}|{link}"
-    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+    return (
+        normalize_text(source),
+        normalize_text(title),
+        normalize_text(summary)[:600],
+        normalize_text(link),
+    )
+
+
+def hash_parts(h: Any, parts: Tuple[str, ...]) -> str:
+    # Same digest as hashing "|".join(parts), without building that string
+    h.update(parts[0].encode("utf-8"))
+    for part in parts[1:]:
+        h.update(b"|")
+        h.update(part.encode("utf-8"))
+    return h.hexdigest()
+
+
+def make_fingerprint(parts: Tuple[str, ...]) -> str:
+    # Local dedup only: a 64-bit blake2b is plenty and keeps state.json small
+    return hash_parts(hashlib.blake2b(digest_size=8), parts)
+
+
+def title_shingles(title: str) -> Set[int]:
+    # Hashes of overlapping 3-word windows; only compared within one process
+    # (str hashes are salted per run), so state keeps the titles themselves
+    words = _RE_WORD.findall(title.lower())
+    if len(words) < 3:
+        return {hash(tuple(words))} if words else set()
+    return {hash(tuple(words[i:i + 3])) for i in range(len(words) - 2)}
+
+
+def is_near_duplicate(shingles: Set[int], recent: List[Set[int]]) -> bool:
+    for other in recent:
+        common = len(shingles & other)
+        if common >= 2 and common / len(shingles | other) >= TITLE_SIMILARITY:
+            return True
+    return False
+
+
+def link_key(link: str) -> str:
+    # Fixed-size key for seen_links: full URLs were most of state.json
+    return hashlib.blake2b(link.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def legacy_fingerprint(parts: Tuple[str, ...]) -> str:
+    # Older state files hold SHA-256 fingerprints (64 hex chars)
+    return hash_parts(hashlib.sha256(), parts)
+
+
+def rekey_legacy(
+    entries: List[Any],
+    source: str,
+    legacy_fps: List[str],
+    seen: Dict[str, int],
+    seen_links: Dict[str, int],
+) -> bool:
+    # Move every entry still known by its SHA-256 key to the new fingerprint
+    # and record its link, so later runs never need the legacy parse again
+    changed = False
+    for e, old_fp in zip(entries, legacy_fps):
+        if old_fp not in seen:
+            continue
+        raw_link = e.get("link") or ""
+        parts = fingerprint_parts(
+            source,
+            e.get("title") or "",
+            e.get("summary") or e.get("description") or "",
+            raw_link,
+        )
+        fp = make_fingerprint(parts)
+        seen[fp] = seen.pop(old_fp)
+        link = normalize_text(raw_link)
+        if link:
+            seen_links[link_key(link)] = seen[fp]
+        changed = True
+    return changed
 
 
 # ---------------------------
 # Telegram
 # ---------------------------
-def telegram_send(message_html: str, disable_preview: bool = False) -> None:
+class RateLimiter:
+    # Sliding window over recent send times: only waits when the window is
+    # full, so a run with a single post never sleeps. Times are recorded
+    # once a send returns, so a slow request cannot bunch two messages.
+    def __init__(self, limit: int, window: float) -> None:
+        self.limit = max(1, limit)
+        self.window = window
+        self.sent: Deque[float] = deque()
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        while self.sent and now - self.sent[0] >= self.window:
+            self.sent.popleft()
+        if len(self.sent) >= self.limit:
+            await asyncio.sleep(self.sent[0] + self.window - now)
+            self.sent.popleft()
+
+    def record(self) -> None:
+        self.sent.append(time.monotonic())
+
+
+async def telegram_send(
+    session: aiohttp.ClientSession, message_html: str, disable_preview: bool = False
+) -> None:
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
     payload = {
         "chat_id": CHAT_ID,
@@ -145,28 +307,26 @@ def telegram_send(message_html: str, disable_preview: bool = False) -> None:
         "parse_mode": "HTML",
         "disable_web_page_preview": disable_preview,
     }
-    r = requests.post(url, json=payload, timeout=REQUEST_TIMEOUT)
-    r.raise_for_status()
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with session.post(url, json=payload, timeout=timeout) as r:
+        r.raise_for_status()
 
 
-def build_message(entry: Any, source: str) -> str:
-    title = norm_space(getattr(entry, "title", "") or "")
-    link = getattr(entry, "link", "") or ""
-    summary = short_summary(entry)
+def source_suffix(source: str) -> str:
+    # Constant for every entry of a feed: build it once per feed
+    return f"Source : {html.escape(source)}"
 
-    parts: List[str] = []
-
-    if title:
-        parts.append(f"<b>{html.escape(title)}</b>")
 
-    if summary:
-        parts.append(html.escape(summary))
+def build_message(title: str, summary: str, link: str, suffix: str) -> str:
+    # title is already cleaned by clean_title
+    summary = short_summary(summary)
 
-    if link:
-        parts.append(f"🔗 <a href=\"{html.escape(link)}\">Lire l’article</a>")
-
-    parts.append(f"Source : {html.escape(source)}")
-    return "\n\n".join(parts)
+    return (
+        (f"<b>{html.escape(title)}</b>\n\n" if title else "")
+        + (f"{html.escape(summary)}\n\n" if summary else "")
+        + (f"🔗 <a href=\"{html.escape(link)}\">Lire l’article</a>\n\n" if link else "")
+        + suffix
+    )
 
 
 # ---------------------------
@@ -174,81 +334,259 @@ def build_message(entry: Any, source: str) -> str:
 # ---------------------------
 def entry_time(entry: Any) -> float:
     # Best-effort ordering; if not available -> 0
-    t = getattr(entry, "published_parsed", None) or getattr(entry, "updated_parsed", None)
+    t = entry.get("published_parsed") or entry.get("updated_parsed")
     if t:
         try:
-            return time.mktime(t)
+            # feedparser normalizes to UTC; mktime would apply local time
+            return float(timegm(t))
         except Exception:
             return 0.0
     return 0.0
 
 
-def parse_feed(url: str) -> Tuple[List[Any], str]:
+async def fetch_feed(
+    session: aiohttp.ClientSession, url: str, cache: Dict[str, str]
+) -> Tuple[str, Optional[bytes], Dict[str, str], Dict[str, str]]:
+    # Conditional GET: body is None when the feed is unchanged (304)
     headers = {"User-Agent": UA}
-    f = feedparser.parse(url, request_headers=headers)
+    if cache.get("etag"):
+        headers["If-None-Match"] = cache["etag"]
+    if cache.get("modified"):
+        headers["If-Modified-Since"] = cache["modified"]
+
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with session.get(url, headers=headers, timeout=timeout) as r:
+        if r.status == 304:
+            return url, None, {}, cache
+        r.raise_for_status()
+        validators = {}
+        if r.headers.get("ETag"):
+            validators["etag"] = r.headers["ETag"]
+        if r.headers.get("Last-Modified"):
+            validators["modified"] = r.headers["Last-Modified"]
+        # What feedparser would have seen fetching the URL itself: the final
+        # URL resolves relative links, the charset decodes the body
+        response_headers = {"content-location": str(r.url)}
+        if r.headers.get("Content-Type"):
+            response_headers["content-type"] = r.headers["Content-Type"]
+        return url, await r.read(), response_headers, validators
+
+
+def parse_feed(
+    body: bytes, response_headers: Dict[str, str], legacy: bool = False
+) -> Tuple[List[Any], str, List[str]]:
+    # Parsing is local (no network): the body was already fetched.
+    # Skip feedparser's sanitizer: summaries go through strip_html and
+    # everything is escaped in build_message before reaching Telegram.
+    f = feedparser.parse(
+        body,
+        response_headers=response_headers,
+        sanitize_html=False,
+        resolve_relative_uris=False,
+    )
 
     # Determine source name
     fallback_link = ""
     try:
-        if f.entries and getattr(f.entries[0], "link", ""):
-            fallback_link = getattr(f.entries[0], "link", "")
+        if f.entries:
+            fallback_link = f.entries[0].get("link") or ""
     except Exception:
         fallback_link = ""
 
     source = nice_source_name(f, fallback_link=fallback_link)
 
-    entries = list(f.entries or [])
-    return entries, source
+    legacy_fps = legacy_fingerprints(body, response_headers) if legacy else []
+    return f.entries or [], source, legacy_fps
+
+
+def legacy_fingerprints(body: bytes, response_headers: Dict[str, str]) -> List[str]:
+    # The SHA-256 keys in older state files were computed from feedparser's
+    # default (sanitized) parse; rebuild them from the same parse, one per entry
+    f = feedparser.parse(body, response_headers=response_headers)
+    fallback_link = (f.entries[0].get("link") or "") if f.entries else ""
+    source = nice_source_name(f, fallback_link=fallback_link)
+    return [
+        legacy_fingerprint(fingerprint_parts(
+            source,
+            e.get("title") or "",
+            e.get("summary") or e.get("description") or "",
+            e.get("link") or "",
+        ))
+        for e in f.entries
+    ]
+
+
+async def load_feed(
+    session: aiohttp.ClientSession,
+    pool: Executor,
+    url: str,
+    cache: Dict[str, str],
+    legacy: bool,
+) -> Tuple[str, Optional[Tuple[List[Any], str, List[str]]], Dict[str, str]]:
+    url, body, response_headers, validators = await fetch_feed(session, url, cache)
+    if body is None:
+        return url, None, validators
+    # feedparser is pure Python and holds the GIL: parse in another process
+    # while the other feeds are still downloading
+    loop = asyncio.get_running_loop()
+    parsed = await loop.run_in_executor(
+        pool, parse_feed, body, response_headers, legacy
+    )
+    return url, parsed, validators
 
 
 # ---------------------------
 # Main
 # ---------------------------
-def main() -> None:
+async def main_async() -> None:
+    # One session for feeds and Telegram: DNS lookups and keep-alive
+    # connections are reused for the whole run.
+    connector = aiohttp.TCPConnector(limit=10, ttl_dns_cache=300)
+    # Workers start on the first parse, once the event loop and aiohttp's
+    # resolver threads exist: forking a threaded process can deadlock, so
+    # start them from a clean forkserver (spawn where that is unavailable)
+    workers = min(len(FEED_URLS), os.cpu_count() or 1)
+    methods = multiprocessing.get_all_start_methods()
+    mp_context = multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
+    )
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await run(session, pool)
+
+
+async def run(session: aiohttp.ClientSession, pool: Executor) -> None:
     state = load_state()
-    seen: List[str] = state.get("seen", [])
-    seen_set: Set[str] = set(seen)
-
-    collected: List[Tuple[Any, str]] = []
-
-    # Collect entries from all feeds
-    for url in FEED_URLS:
+    # fingerprint -> time posted, in insertion (oldest first) order
+    seen: Dict[str, int] = state["seen"]
+    # link_key(normalized link) -> time posted; checked before the fingerprint
+    seen_links: Dict[str, int] = state["seen_links"]
+    has_legacy = any(len(fp) == 64 for fp in seen)
+
+    # Last posted titles, oldest first, for the cross-source near-dup check
+    recent_titles: List[str] = state["recent_titles"]
+    recent_shingles = [title_shingles(t) for t in recent_titles]
+
+    # url -> {"etag": ..., "modified": ...} from the last complete run
+    feeds: Dict[str, Dict[str, str]] = state["feeds"]
+
+    # One old -> new list of (time, entry, source, suffix, url) per feed
+    per_feed: List[List[Tuple[float, Any, str, str, str]]] = []
+    sources: Set[str] = set()
+    changed = False
+    # Feeds whose entries were all checked against the legacy keys
+    checked = 0
+    # Validators fetched this run, and entries per feed not yet handled
+    validators: Dict[str, Dict[str, str]] = {}
+    pending: Dict[str, int] = {}
+
+    # Fetch and parse all feeds concurrently
+    results = await asyncio.gather(
+        *[
+            load_feed(session, pool, url, feeds.get(url, {}), has_legacy)
+            for url in FEED_URLS
+        ],
+        return_exceptions=True,
+    )
+
+    for res in results:
+        if isinstance(res, BaseException):
+            continue
         try:
-            entries, source = parse_feed(url)
-            for e in entries:
-                collected.append((e, source))
+            url, parsed, cache = res
+            validators[url] = cache
+            if parsed is None:
+                # 304 Not Modified: nothing to parse
+                pending[url] = 0
+                checked += 1
+                continue
+            entries, source, legacy_fps = parsed
+            if has_legacy and len(legacy_fps) == len(entries):
+                changed |= rekey_legacy(entries, source, legacy_fps, seen, seen_links)
+                checked += 1
+            suffix = source_suffix(source)
+            items = [(entry_time(e), e, source, suffix, url) for e in entries]
+            # Publishers list newest first, so this is a cheap run reversal
+            items.sort(key=lambda x: x[0])
+            per_feed.append(items)
+            sources.add(source)
+            pending[url] = len(entries)
         except Exception:
             continue
 
-    if not collected:
-        return
+    if has_legacy and checked == len(FEED_URLS):
+        # Every feed was checked against the legacy keys: the ones left
+        # belong to articles no longer published, so drop them now
+        for old_fp in [fp for fp in seen if len(fp) == 64]:
+            del seen[old_fp]
+        changed = True
 
-    # Sort old -> new
-    collected.sort(key=lambda x: entry_time(x[0]))
+    # Merge the per-feed lists old -> new, lazily
+    collected = heapq.merge(*per_feed, key=lambda x: x[0])
 
     posted = 0
     new_seen: List[str] = []
     used_sources: Set[str] = set()
+    limiter = RateLimiter(RATE_LIMIT, RATE_WINDOW)
+
+    for _ts, e, source, suffix, url in collected:
+        # Cheap check first: a known link skips the full fingerprint
+        raw_link = e.get("link") or ""
+        link = normalize_text(raw_link)
+        lk = link_key(link) if link else ""
+        if lk and lk in seen_links:
+            pending[url] -= 1
+            continue
+
+        # Read each field once; FeedParserDict attribute access is costly
+        raw_title = e.get("title") or ""
+        summary = e.get("summary") or e.get("description") or ""
+
+        parts = fingerprint_parts(source, raw_title, summary, raw_link)
+        fp = make_fingerprint(parts)
+        if not fp:
+            pending[url] -= 1
+            continue
 
-    for e, source in collected:
-        fp = make_fingerprint(e, source)
-        if not fp or fp in seen_set:
+        if fp in seen:
+            if lk:
+                seen_links[lk] = seen[fp]
+                changed = True
+            pending[url] -= 1
+            continue
+
+        # Plain text from here on: shingles, history and message agree
+        title = clean_title(raw_title)
+        shingles = title_shingles(title)
+        if is_near_duplicate(shingles, recent_shingles):
+            # Same story from another source: remember it as seen
+            seen[fp] = int(time.time())
+            if lk:
+                seen_links[lk] = seen[fp]
+            changed = True
+            pending[url] -= 1
             continue
 
         if ONE_PER_SOURCE and source in used_sources:
             continue
 
-        msg = build_message(e, source)
+        msg = build_message(title, summary, raw_link, suffix)
 
         try:
-            telegram_send(msg, disable_preview=False)
+            await limiter.wait()
+            await telegram_send(session, msg, disable_preview=False)
+            limiter.record()
             posted += 1
             used_sources.add(source)
 
-            seen_set.add(fp)
+            seen[fp] = int(time.time())
+            if lk:
+                seen_links[lk] = seen[fp]
             new_seen.append(fp)
+            pending[url] -= 1
 
-            time.sleep(SLEEP_BETWEEN_POSTS)
+            recent_titles.append(title)
+            recent_shingles.append(shingles)
         except Exception:
             # Stop to avoid repeated failures / duplicates
             break
@@ -256,10 +594,37 @@ def main() -> None:
         if posted >= MAX_POSTS_PER_RUN:
             break
 
+        if ONE_PER_SOURCE and used_sources >= sources:
+            # Every source has posted: nothing left can be sent this run
+            break
+
+    # Only keep a feed's validators once all its entries were handled;
+    # otherwise a 304 next run would hide the entries held back this run.
+    for url, left in pending.items():
+        cache = validators[url] if left == 0 else {}
+        if feeds.get(url, {}) != cache:
+            if cache:
+                feeds[url] = cache
+            else:
+                feeds.pop(url, None)
+            changed = True
+
+    if not new_seen and not changed:
+        return
+
     # Persist state
-    state["seen"] = (seen + new_seen)[-SEEN_LIMIT:]
+    if len(seen) > SEEN_LIMIT:
+        state["seen"] = dict(list(seen.items())[-SEEN_LIMIT:])
+    if len(seen_links) > SEEN_LIMIT:
+        state["seen_links"] = dict(list(seen_links.items())[-SEEN_LIMIT:])
+    if len(recent_titles) > TITLE_HISTORY:
+        state["recent_titles"] = recent_titles[-TITLE_HISTORY:]
     save_state(state)
 
 
+def main() -> None:
+    asyncio.run(main_async())
+
+
 if __name__ == "__main__":
     main()